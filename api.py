@@ -1,16 +1,23 @@
 from fastapi import FastAPI, HTTPException, UploadFile, File, Query
 from fastapi.middleware.cors import CORSMiddleware
 from telethon import TelegramClient
-from telethon.errors import ChatInvalidError
+from telethon.errors import ChatInvalidError, ServerError
 from dotenv import load_dotenv
-from datetime import datetime
-import pytz
+from datetime import datetime, timedelta, timezone
 import os
+import re
+import io
+import gzip
 import logging
-import json
-import aiofiles
+import asyncio
+from functools import lru_cache
+import orjson
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception, retry_if_exception_type
 import boto3
-from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionClosedError, ReadTimeoutError
+from botocore.exceptions import ConnectionError as BotoConnectionError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -44,9 +51,44 @@ PHONE_NUMBER = os.getenv('PHONENUMBER')
 AWS_REGION = os.getenv('AWS_REGION')
 S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
 
+# Shared S3 client settings: a connection pool large enough for concurrent uploads
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=32,
+    retries={'max_attempts': 3, 'mode': 'adaptive'}
+)
+
+# S3 error codes that are retried on top of 5xx responses
+TRANSIENT_S3_ERROR_CODES = {'SlowDown', 'RequestTimeout'}
+
+# Large dumps are sent as parallel multipart uploads, smaller ones as a single PUT.
+# UPLOAD_WORKERS * max_concurrency must stay within max_pool_connections above.
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True
+)
+
+# Maximum number of chats processed concurrently
+MAX_CONCURRENT_CHATS = 8
+
+# Usernames (leading @ already stripped) or numeric chat IDs; anything else is skipped
+USERNAME_PATTERN = re.compile(r'^([A-Za-z0-9_]{4,32}|-?[0-9]+)$')
+CHAT_ID_PATTERN = re.compile(r'^-?[0-9]+$')
+
+# Pending serialized chats buffered between the downloaders and the S3 uploaders
+UPLOAD_QUEUE_SIZE = 4
+UPLOAD_WORKERS = 4
+
 # Global Telegram client
 client = TelegramClient('session_name', API_ID, API_HASH)
 
+# Resolved input peers by username or chat ID, so repeat lookups skip the ResolveUsername request
+_entity_cache = {}
+
+# Buckets already confirmed to exist, so later runs skip the head_bucket round trip
+_ready_buckets = set()
+
 def parse_date(date_string: str):
     """
     Parse date string to datetime object with UTC timezone
@@ -61,20 +103,22 @@ def parse_date(date_string: str):
         HTTPException: If date format is invalid
     """
     try:
-        return datetime.strptime(date_string, "%Y-%m-%d").replace(tzinfo=pytz.UTC)
+        return datetime.strptime(date_string, "%Y-%m-%d").replace(tzinfo=timezone.utc)
     except ValueError:
         raise HTTPException(
             status_code=400, 
             detail="Invalid date format. Use YYYY-MM-DD."
         )
 
+@lru_cache(maxsize=1)
 def create_s3_client():
-    """Create an S3 client using credentials from .env."""
+    """Return the shared S3 client, created on first use from .env credentials."""
     return boto3.client(
         's3',
         aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
         aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-        region_name=AWS_REGION
+        region_name=AWS_REGION,
+        config=S3_CLIENT_CONFIG
     )
 
 async def create_s3_bucket(bucket_name: str):
@@ -84,18 +128,24 @@ async def create_s3_bucket(bucket_name: str):
     Args:
         bucket_name (str): Name of the S3 bucket.
     """
+    if bucket_name in _ready_buckets:
+        return
+
     s3_client = create_s3_client()
     try:
-        s3_client.head_bucket(Bucket=bucket_name)
+        await asyncio.to_thread(s3_client.head_bucket, Bucket=bucket_name)
         logger.info(f"Bucket '{bucket_name}' already exists.")
+        _ready_buckets.add(bucket_name)
     except ClientError:
         # Bucket doesn't exist, create it
         try:
-            s3_client.create_bucket(
+            await asyncio.to_thread(
+                s3_client.create_bucket,
                 Bucket=bucket_name,
                 CreateBucketConfiguration={'LocationConstraint': AWS_REGION}
             )
             logger.info(f"Bucket '{bucket_name}' created successfully.")
+            _ready_buckets.add(bucket_name)
         except Exception as e:
             logger.error(f"Failed to create bucket '{bucket_name}': {e}")
             raise HTTPException(
@@ -103,22 +153,68 @@ async def create_s3_bucket(bucket_name: str):
                 detail=f"Failed to create bucket '{bucket_name}': {str(e)}"
             )
 
-async def upload_file_to_s3(bucket_name: str, file_path: str, key: str) -> str:
+def _is_transient_s3_error(exc: BaseException) -> bool:
+    """
+    Whether an S3 failure is worth retrying: connection problems, timeouts,
+    throttling and 5xx responses. Permanent errors such as AccessDenied are not.
     """
-    Upload a file to an S3 bucket and return the HTTPS URL.
+    # BotoConnectionError covers endpoint, proxy and connect-timeout failures
+    if isinstance(exc, (BotoConnectionError, ReadTimeoutError, ConnectionClosedError)):
+        return True
+    if isinstance(exc, ClientError):
+        code = exc.response.get('Error', {}).get('Code')
+        status = exc.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return status >= 500 or code in TRANSIENT_S3_ERROR_CODES
+    return False
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, max=8),
+    retry=retry_if_exception(_is_transient_s3_error),
+    reraise=True
+)
+async def _put_payload(s3_client, bucket_name: str, body: bytes, key: str):
+    """
+    Send a gzip-compressed JSON Lines payload to S3, retrying transient failures with exponential backoff.
+
+    Payloads above the multipart threshold go through s3transfer, smaller ones
+    through a single put_object call.
+    """
+    if len(body) >= S3_TRANSFER_CONFIG.multipart_threshold:
+        await asyncio.to_thread(
+            s3_client.upload_fileobj,
+            io.BytesIO(body),
+            bucket_name,
+            key,
+            ExtraArgs={'ContentType': 'application/x-ndjson', 'ContentEncoding': 'gzip'},
+            Config=S3_TRANSFER_CONFIG
+        )
+    else:
+        await asyncio.to_thread(
+            s3_client.put_object,
+            Bucket=bucket_name,
+            Key=key,
+            Body=body,
+            ContentType='application/x-ndjson',
+            ContentEncoding='gzip'
+        )
+
+async def upload_json_to_s3(bucket_name: str, body: bytes, key: str) -> str:
+    """
+    Upload gzip-compressed JSON Lines to an S3 bucket and return the HTTPS URL.
     
     Args:
         bucket_name (str): Name of the S3 bucket.
-        file_path (str): Local file path to upload.
-        key (str): Key name for the file in S3.
+        body (bytes): Gzip-compressed JSON Lines payload to upload.
+        key (str): Key name for the object in S3.
 
     Returns:
-        str: The HTTPS URL of the uploaded file.
+        str: The HTTPS URL of the uploaded object.
     """
     s3_client = create_s3_client()
     try:
-        s3_client.upload_file(file_path, bucket_name, key)
-        logger.info(f"File '{file_path}' uploaded to S3 bucket '{bucket_name}' as '{key}'.")
+        await _put_payload(s3_client, bucket_name, body, key)
+        logger.info(f"Object '{key}' uploaded to S3 bucket '{bucket_name}'.")
         # Generate the HTTPS URL
         region = os.getenv("AWS_REGION")
         s3_url = f"https://{bucket_name}.s3.{region}.amazonaws.com/{key}"
@@ -130,10 +226,78 @@ async def upload_file_to_s3(bucket_name: str, file_path: str, key: str) -> str:
             detail=f"Failed to upload file to S3: {str(e)}"
         )
 
+def _write_payload(path: str, body: bytes):
+    """
+    Write a gzip-compressed JSON Lines payload to disk in a single buffered write.
+
+    Args:
+        path (str): Local file path to write.
+        body (bytes): Gzip-compressed JSON Lines payload.
+    """
+    with open(path, 'wb', buffering=1 << 20) as f:
+        f.write(body)
+
+
+async def _iter_messages(username: str, from_date: datetime = None, to_date: datetime = None):
+    """
+    Yield text messages in the date range one at a time, newest first.
+    """
+    # Messages come newest first, starting just before offset_date, so
+    # Telegram only sends what is on or before to_date
+    offset_date = to_date + timedelta(days=1) if to_date else None
+    from_day = from_date.date() if from_date else None
+
+    # Telethon treats an all-digit string as a phone number, so chat IDs must be ints
+    entity = int(username) if CHAT_ID_PATTERN.match(username) else username
+    peer = _entity_cache.get(entity)
+    if peer is None:
+        peer = await client.get_input_entity(entity)
+        _entity_cache[entity] = peer
+
+    async for message in client.iter_messages(peer, offset_date=offset_date):
+        if not message.date:
+            continue  # Skip messages without a valid date
+
+        # Telethon dates are already UTC; everything from here on is older than the range.
+        # Checked before message.text so the loop still stops on non-text messages.
+        if from_day and message.date.date() < from_day:
+            break
+
+        if message.text:
+            yield {
+                "date": message.date.isoformat(),
+                "sender_id": message.sender_id,
+                "message": message.text,
+                "message_id": message.id
+            }
+
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, max=8),
+    retry=retry_if_exception_type((ConnectionError, ServerError)),
+    reraise=True
+)
+async def _fetch_jsonl(username: str, from_date: datetime = None, to_date: datetime = None) -> tuple:
+    """
+    Serialize messages as JSON Lines while they stream in, retrying transient
+    Telegram failures with exponential backoff.
+
+    Each message is encoded as soon as it arrives, so only the serialized bytes
+    are kept in memory rather than a list of message dicts.
+    """
+    buffer = io.BytesIO()
+    message_count = 0
+    async for message in _iter_messages(username, from_date, to_date):
+        buffer.write(orjson.dumps(message))
+        buffer.write(b"\n")
+        message_count += 1
+
+    return buffer.getvalue(), message_count
+
 
 async def download_chat_messages(
     username: str,
-    token_name: str,
     from_date: datetime = None,
     to_date: datetime = None
 ):
@@ -142,48 +306,18 @@ async def download_chat_messages(
 
     Args:
         username (str): Chat username or ID.
-        token_name (str): Token name for the group/chat.
         from_date (datetime, optional): Start date for filtering messages.
         to_date (datetime, optional): End date for filtering messages.
 
     Returns:
-        dict: Dictionary containing token_name, message_count, and the list of messages.
+        tuple: The messages as JSON Lines bytes (one object per line) and the message count.
     """
     try:
         # Ensure the client is connected
         if not client.is_connected():
             await client.start(phone=PHONE_NUMBER)
 
-        messages = []
-
-        async for message in client.iter_messages(username, limit=None):  # No hard limit on iteration
-            if not message.date:
-                continue  # Skip messages without a valid date
-
-            # Convert message date to UTC
-            message_date = message.date.astimezone(pytz.UTC).date()
-
-            # Apply date filtering
-            if from_date and message_date < from_date.date():
-                continue
-            if to_date and message_date > to_date.date():
-                continue
-
-            # Add the message to the list
-            if message.text:
-                messages.append({
-                    "date": message.date.isoformat(),
-                    "sender_id": message.sender_id,
-                    "message": message.text,
-                    "message_id": message.id
-                })
-
-        # Return the messages and metadata
-        return {
-            "token_name": token_name,
-            "message_count": len(messages),
-            "messages": messages
-        }
+        return await _fetch_jsonl(username, from_date, to_date)
 
     except ChatInvalidError:
         logger.error(f"Chat not found: {username}")
@@ -203,7 +337,8 @@ async def download_chat_messages(
 async def process_messages_file(
     file: UploadFile = File(...),
     from_date: str = Query(None, description="Start date (YYYY-MM-DD)"),
-    to_date: str = Query(None, description="End date (YYYY-MM-DD)")
+    to_date: str = Query(None, description="End date (YYYY-MM-DD)"),
+    keep_local: bool = Query(False, description="Also save the JSON files on the server")
 ):
     """
     Process a file containing group/usernames and save messages to JSON files, then upload to S3.
@@ -212,6 +347,7 @@ async def process_messages_file(
     - file: File containing list of usernames or group names.
     - from_date: Optional start date for filtering.
     - to_date: Optional end date for filtering.
+    - keep_local: Keep a local copy of each JSON file in addition to the S3 upload.
 
     Returns:
     JSON response summarizing the processing status.
@@ -223,59 +359,114 @@ async def process_messages_file(
 
         # Read group/usernames from uploaded file
         content = await file.read()
-        usernames = content.decode('utf-8').splitlines()
+        # Strip once (including a leading @), skip blank lines and drop duplicate chats, keeping file order
+        lines = (line.strip().removeprefix('@') for line in content.decode('utf-8').splitlines())
+        usernames = list(dict.fromkeys(filter(None, lines)))
+
+        # Drop malformed entries before any network work is started for them
+        skipped = [username for username in usernames if not USERNAME_PATTERN.match(username)]
+        usernames = [username for username in usernames if USERNAME_PATTERN.match(username)]
+        skipped_summary = [
+            {"username": username, "status": "skipped", "error": "Invalid username or chat ID."}
+            for username in skipped
+        ]
 
-        result_summary = []
         bucket_name = S3_BUCKET_NAME
 
         # Ensure the S3 bucket exists
         await create_s3_bucket(bucket_name)
-        
-        for username in usernames:
-            token_name = f"Token_{username.strip()}"
-            try:
-                # Download messages
-                result = await download_chat_messages(
-                    username=username.strip(),
-                    token_name=token_name,
-                    from_date=from_date_obj,
-                    to_date=to_date_obj
-                )
-                
-                # Save messages to JSON file
-                filename = f"telegram_{username.strip()}_{datetime.now().strftime('%Y_%m_%d')}.json"
-                async with aiofiles.open(filename, mode='w') as f:
-                    await f.write(json.dumps(result, indent=4))
-
-                # Upload JSON file to S3
-                region = os.getenv("AWS_REGION")
-                s3_key = filename  # Use filename as the S3 object key
-                s3_url = f"https://{bucket_name}.s3.{region}.amazonaws.com/{s3_key}"
-                await upload_file_to_s3(bucket_name, filename, s3_key)
-
-                # Append success response
-                result_summary.append({
-                    "username": username.strip(),
-                    "status": "success",
-                    "message_count": result["message_count"],
-                    "s3_file": s3_url  # Include HTTPS URL
-                })
-            except HTTPException as e:
-                # Append failure response for HTTP exceptions
-                result_summary.append({
-                    "username": username.strip(),
-                    "status": "failed",
-                    "error": e.detail
-                })
-            except Exception as e:
-                # Append failure response for other exceptions
-                result_summary.append({
-                    "username": username.strip(),
-                    "status": "failed",
-                    "error": str(e)
-                })
-        
-        return {"summary": result_summary}
+
+        # Connect once up front so concurrent downloads don't race on client.start()
+        if not client.is_connected():
+            await client.start(phone=PHONE_NUMBER)
+
+        # One date tag per run, so a run that crosses midnight doesn't mix filenames
+        date_tag = datetime.now(timezone.utc).strftime('%Y_%m_%d')
+
+        sem = asyncio.Semaphore(MAX_CONCURRENT_CHATS)
+        queue = asyncio.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+        result_summary = [None] * len(usernames)
+
+        def _failed(username: str, error: str) -> dict:
+            """Build a failure entry for the summary."""
+            return {
+                "username": username,
+                "status": "failed",
+                "error": error
+            }
+
+        async def _download_user(index: int, username: str):
+            """Download and serialize messages for a single username, then queue them for upload."""
+            async with sem:
+                try:
+                    # Download messages, serialized as they arrive so the uploader only has to do I/O
+                    body, message_count = await download_chat_messages(
+                        username=username,
+                        from_date=from_date_obj,
+                        to_date=to_date_obj
+                    )
+                    filename = f"telegram_{username}_{date_tag}.jsonl.gz"
+                except HTTPException as e:
+                    result_summary[index] = _failed(username, e.detail)
+                    return
+                except Exception as e:
+                    result_summary[index] = _failed(username, str(e))
+                    return
+
+                # Hold the download slot until the payload is queued, so at most
+                # MAX_CONCURRENT_CHATS + UPLOAD_QUEUE_SIZE payloads are in memory
+                await queue.put((index, username, filename, body, message_count))
+
+        async def producer():
+            """Download all chats, then signal each consumer to stop."""
+            results = await asyncio.gather(
+                *[_download_user(index, username) for index, username in enumerate(usernames)],
+                return_exceptions=True
+            )
+
+            # Normalize anything that escaped _download_user into the failed format
+            for index, (username, result) in enumerate(zip(usernames, results)):
+                if isinstance(result, BaseException):
+                    result_summary[index] = _failed(username, str(result))
+
+            for _ in range(UPLOAD_WORKERS):
+                await queue.put(None)
+
+        async def consumer():
+            """Upload queued JSON payloads to S3, optionally keeping a local copy."""
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+
+                index, username, filename, body, message_count = item
+                try:
+                    # Compress in a worker thread so it overlaps with the downloads
+                    body = await asyncio.to_thread(gzip.compress, body, compresslevel=3)
+
+                    # Save messages to JSON file only if asked to
+                    if keep_local:
+                        await asyncio.to_thread(_write_payload, filename, body)
+
+                    # Upload JSON straight from memory, using the filename as the object key
+                    s3_url = await upload_json_to_s3(bucket_name, body, filename)
+
+                    # Success response
+                    result_summary[index] = {
+                        "username": username,
+                        "status": "success",
+                        "message_count": message_count,
+                        "s3_file": s3_url  # Include HTTPS URL
+                    }
+                except HTTPException as e:
+                    result_summary[index] = _failed(username, e.detail)
+                except Exception as e:
+                    result_summary[index] = _failed(username, str(e))
+
+        # Uploads of finished chats overlap with downloads of the remaining ones
+        await asyncio.gather(producer(), *[consumer() for _ in range(UPLOAD_WORKERS)])
+
+        return {"summary": result_summary + skipped_summary}
     
     except Exception as e:
         logger.error(f"Error processing file: {e}")
@@ -295,6 +486,17 @@ async def health_check():
         "service": "Telegram Message Downloader"
     }
 
+@app.on_event("startup")
+async def startup_event():
+    """
+    Check the S3 bucket once at startup so the first request doesn't pay for it.
+    """
+    try:
+        await create_s3_bucket(S3_BUCKET_NAME)
+    except Exception as e:
+        # Not fatal: the bucket is checked again on the next request
+        logger.error(f"Error checking S3 bucket on startup: {e}")
+
 @app.on_event("shutdown")
 async def shutdown_event():
     """
@@ -2,18 +2,26 @@ import argparse
 from fastapi import FastAPI, HTTPException, UploadFile, File, Query
 from fastapi.middleware.cors import CORSMiddleware
 from telethon import TelegramClient
-from telethon.errors import ChatInvalidError
+from telethon.errors import ChatInvalidError, ServerError
 from dotenv import load_dotenv
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from datetime import datetime, timedelta
-import pytz
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 import os
+import re
+import io
+import gzip
 import logging
-import json
-import aiofiles
+import asyncio
+from functools import lru_cache
+import orjson
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception, retry_if_exception_type
 import boto3
-from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionClosedError, ReadTimeoutError
+from botocore.exceptions import ConnectionError as BotoConnectionError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -27,6 +35,9 @@ parser = argparse.ArgumentParser(description="Telegram Message Downloader Servic
 parser.add_argument(
     "username_file", type=str, help="Path to the file containing usernames or group names."
 )
+parser.add_argument(
+    "--keep_local", action="store_true", help="Also save the JSON files locally."
+)
 args = parser.parse_args()
 
 # API configuration
@@ -54,28 +65,211 @@ PHONE_NUMBER = os.getenv('PHONENUMBER')
 AWS_REGION = os.getenv('AWS_REGION')
 S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
 
+# Shared S3 client settings: a connection pool large enough for concurrent uploads
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=32,
+    retries={'max_attempts': 3, 'mode': 'adaptive'}
+)
+
+# S3 error codes that are retried on top of 5xx responses
+TRANSIENT_S3_ERROR_CODES = {'SlowDown', 'RequestTimeout'}
+
+# Large dumps are sent as parallel multipart uploads, smaller ones as a single PUT.
+# MAX_CONCURRENT_CHATS * max_concurrency must stay within max_pool_connections above.
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+    use_threads=True
+)
+
+# Maximum number of chats processed concurrently
+MAX_CONCURRENT_CHATS = 8
+
+# Usernames (leading @ already stripped) or numeric chat IDs; anything else is skipped
+USERNAME_PATTERN = re.compile(r'^([A-Za-z0-9_]{4,32}|-?[0-9]+)$')
+CHAT_ID_PATTERN = re.compile(r'^-?[0-9]+$')
+
 # Global Telegram client
 client = TelegramClient('session_name', API_ID, API_HASH)
 
+# Resolved input peers by username or chat ID, so repeat lookups skip the ResolveUsername request
+_entity_cache = {}
+
+# Buckets already confirmed to exist, so later runs skip the head_bucket round trip
+_ready_buckets = set()
+
 # Function to parse dates
 def parse_date(date_string: str):
     try:
-        return datetime.strptime(date_string, "%Y-%m-%d").replace(tzinfo=pytz.UTC)
+        return datetime.strptime(date_string, "%Y-%m-%d").replace(tzinfo=timezone.utc)
     except ValueError:
         raise HTTPException(
             status_code=400, 
             detail="Invalid date format. Use YYYY-MM-DD."
         )
 
-# Create S3 client
+# Shared S3 client, created on first use and reused so its connection pool is kept
+@lru_cache(maxsize=1)
 def create_s3_client():
     return boto3.client(
         's3',
         aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
         aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-        region_name=AWS_REGION
+        region_name=AWS_REGION,
+        config=S3_CLIENT_CONFIG
     )
 
+# Create the S3 bucket if it doesn't exist
+async def create_s3_bucket(bucket_name):
+    if bucket_name in _ready_buckets:
+        return
+
+    s3_client = create_s3_client()
+    try:
+        await asyncio.to_thread(s3_client.head_bucket, Bucket=bucket_name)
+        logger.info(f"Bucket '{bucket_name}' already exists.")
+        _ready_buckets.add(bucket_name)
+    except ClientError:
+        # Bucket doesn't exist, create it
+        try:
+            await asyncio.to_thread(
+                s3_client.create_bucket,
+                Bucket=bucket_name,
+                CreateBucketConfiguration={'LocationConstraint': AWS_REGION}
+            )
+            logger.info(f"Bucket '{bucket_name}' created successfully.")
+            _ready_buckets.add(bucket_name)
+        except Exception as e:
+            logger.error(f"Failed to create bucket '{bucket_name}': {e}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to create bucket '{bucket_name}': {str(e)}"
+            )
+
+# Only connection problems, timeouts, throttling and 5xx responses are worth retrying
+def _is_transient_s3_error(exc):
+    # BotoConnectionError covers endpoint, proxy and connect-timeout failures
+    if isinstance(exc, (BotoConnectionError, ReadTimeoutError, ConnectionClosedError)):
+        return True
+    if isinstance(exc, ClientError):
+        code = exc.response.get('Error', {}).get('Code')
+        status = exc.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return status >= 500 or code in TRANSIENT_S3_ERROR_CODES
+    return False
+
+# Send a gzip-compressed JSON Lines payload to S3, retrying transient failures with exponential backoff
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, max=8),
+    retry=retry_if_exception(_is_transient_s3_error),
+    reraise=True
+)
+async def _put_payload(s3_client, bucket_name, body, key):
+    if len(body) >= S3_TRANSFER_CONFIG.multipart_threshold:
+        await asyncio.to_thread(
+            s3_client.upload_fileobj,
+            io.BytesIO(body),
+            bucket_name,
+            key,
+            ExtraArgs={'ContentType': 'application/x-ndjson', 'ContentEncoding': 'gzip'},
+            Config=S3_TRANSFER_CONFIG
+        )
+    else:
+        await asyncio.to_thread(
+            s3_client.put_object,
+            Bucket=bucket_name,
+            Key=key,
+            Body=body,
+            ContentType='application/x-ndjson',
+            ContentEncoding='gzip'
+        )
+
+# Upload gzip-compressed JSON Lines to S3 and return its HTTPS URL
+async def upload_json_to_s3(bucket_name, body, key):
+    s3_client = create_s3_client()
+    try:
+        await _put_payload(s3_client, bucket_name, body, key)
+        logger.info(f"Object '{key}' uploaded to S3 bucket '{bucket_name}'.")
+        s3_url = f"https://{bucket_name}.s3.{AWS_REGION}.amazonaws.com/{key}"
+        return s3_url
+    except Exception as e:
+        logger.error(f"Failed to upload file to S3: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to upload file to S3: {str(e)}"
+        )
+
+# Write a gzip-compressed JSON Lines payload to disk in a single buffered write
+def _write_payload(path, body):
+    with open(path, 'wb', buffering=1 << 20) as f:
+        f.write(body)
+
+# Yield text messages in the date range one at a time, newest first
+async def _iter_messages(username, from_date=None, to_date=None):
+    # Newest first, starting just before offset_date; stop once past from_date
+    offset_date = to_date + timedelta(days=1) if to_date else None
+    from_day = from_date.date() if from_date else None
+    # Telethon treats an all-digit string as a phone number, so chat IDs must be ints
+    entity = int(username) if CHAT_ID_PATTERN.match(username) else username
+    peer = _entity_cache.get(entity)
+    if peer is None:
+        peer = await client.get_input_entity(entity)
+        _entity_cache[entity] = peer
+
+    async for message in client.iter_messages(peer, offset_date=offset_date):
+        if not message.date:
+            continue
+
+        # Telethon dates are already UTC
+        if from_day and message.date.date() < from_day:
+            break
+
+        if message.text:
+            yield {
+                "date": message.date.isoformat(),
+                "sender_id": message.sender_id,
+                "message": message.text,
+                "message_id": message.id
+            }
+
+# Serialize messages as JSON Lines while they stream in, retrying transient Telegram failures
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, max=8),
+    retry=retry_if_exception_type((ConnectionError, ServerError)),
+    reraise=True
+)
+async def _fetch_jsonl(username, from_date=None, to_date=None):
+    buffer = io.BytesIO()
+    message_count = 0
+    async for message in _iter_messages(username, from_date, to_date):
+        buffer.write(orjson.dumps(message))
+        buffer.write(b"\n")
+        message_count += 1
+
+    return buffer.getvalue(), message_count
+
+# Download messages from a Telegram chat for a date range as JSON Lines bytes and a count
+async def download_chat_messages(username, from_date=None, to_date=None):
+    try:
+        if not client.is_connected():
+            await client.start(phone=PHONE_NUMBER)
+
+        return await _fetch_jsonl(username, from_date, to_date)
+    except ChatInvalidError:
+        logger.error(f"Chat not found: {username}")
+        raise HTTPException(
+            status_code=404,
+            detail=f"Chat '{username}' not found or inaccessible."
+        )
+    except Exception as e:
+        logger.error(f"Error downloading messages: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error downloading messages: {str(e)}"
+        )
+
 # Async function to process messages
 async def process_messages_daily():
     """
@@ -86,77 +280,110 @@ async def process_messages_daily():
 
     try:
         # Calculate date range for the previous day in Pacific Time
-        pacific = pytz.timezone("US/Pacific")
+        pacific = ZoneInfo("US/Pacific")
         now = datetime.now(pacific)
         from_date = (now - timedelta(days=1)).strftime("%Y-%m-%d")
         to_date = from_date  # Same day for start and end of range
 
+        # Parse once; the range is the same for every username
+        from_date_obj = parse_date(from_date)
+        to_date_obj = parse_date(to_date)
+
         # Read usernames from the file
         with open(args.username_file, "r") as file:
-            usernames = [line.strip() for line in file.readlines()]
+            # Strip once (including a leading @), skip blank lines and drop duplicate chats, keeping file order
+            usernames = list(dict.fromkeys(filter(None, (line.strip().removeprefix('@') for line in file))))
+
+        # Drop malformed entries before any network work is started for them
+        skipped = [username for username in usernames if not USERNAME_PATTERN.match(username)]
+        usernames = [username for username in usernames if USERNAME_PATTERN.match(username)]
+        skipped_summary = [
+            {"username": username, "status": "skipped", "error": "Invalid username or chat ID."}
+            for username in skipped
+        ]
 
-        result_summary = []
         bucket_name = S3_BUCKET_NAME
 
         # Ensure the S3 bucket exists
         await create_s3_bucket(bucket_name)
 
-        for username in usernames:
-            token_name = f"Token_{username.strip()}"
-            try:
-                # Download messages
-                result = await download_chat_messages(
-                    username=username.strip(),
-                    token_name=token_name,
-                    from_date=parse_date(from_date),
-                    to_date=parse_date(to_date)
-                )
-                
-                # Save messages to JSON file
-                filename = f"telegram_{username.strip()}_{datetime.now().strftime('%Y_%m_%d')}.json"
-                async with aiofiles.open(filename, mode='w') as f:
-                    await f.write(json.dumps(result, indent=4))
-
-                # Upload JSON file to S3
-                s3_key = filename
-                s3_url = await upload_file_to_s3(bucket_name, filename, s3_key)
-
-                # Append success response
-                result_summary.append({
-                    "username": username.strip(),
-                    "status": "success",
-                    "message_count": result["message_count"],
-                    "s3_file": s3_url
-                })
-            except HTTPException as e:
-                # Append failure response for HTTP exceptions
-                result_summary.append({
-                    "username": username.strip(),
-                    "status": "failed",
-                    "error": e.detail
-                })
-            except Exception as e:
-                # Append failure response for other exceptions
-                result_summary.append({
-                    "username": username.strip(),
-                    "status": "failed",
-                    "error": str(e)
-                })
-        
+        # Connect once up front so concurrent downloads don't race on client.start()
+        if not client.is_connected():
+            await client.start(phone=PHONE_NUMBER)
+
+        # One date tag per run, so a run that crosses midnight doesn't mix filenames
+        date_tag = datetime.now(timezone.utc).strftime('%Y_%m_%d')
+
+        sem = asyncio.Semaphore(MAX_CONCURRENT_CHATS)
+
+        async def _handle_user(username):
+            """Download, save and upload messages for a single username."""
+            async with sem:
+                try:
+                    # Download messages, serialized as JSON Lines as they arrive
+                    body, message_count = await download_chat_messages(
+                        username=username,
+                        from_date=from_date_obj,
+                        to_date=to_date_obj
+                    )
+
+                    # Compress once for the upload and the optional local copy
+                    filename = f"telegram_{username}_{date_tag}.jsonl.gz"
+                    body = await asyncio.to_thread(gzip.compress, body, compresslevel=3)
+                    if args.keep_local:
+                        await asyncio.to_thread(_write_payload, filename, body)
+
+                    # Upload JSON straight from memory
+                    s3_key = filename
+                    s3_url = await upload_json_to_s3(bucket_name, body, s3_key)
+
+                    # Success response
+                    return {
+                        "username": username,
+                        "status": "success",
+                        "message_count": message_count,
+                        "s3_file": s3_url
+                    }
+                except HTTPException as e:
+                    # Failure response for HTTP exceptions
+                    return {
+                        "username": username,
+                        "status": "failed",
+                        "error": e.detail
+                    }
+                except Exception as e:
+                    # Failure response for other exceptions
+                    return {
+                        "username": username,
+                        "status": "failed",
+                        "error": str(e)
+                    }
+
+        results = await asyncio.gather(
+            *[_handle_user(username) for username in usernames],
+            return_exceptions=True
+        )
+
+        # Normalize anything that escaped _handle_user into the failed format
+        result_summary = [
+            {"username": username, "status": "failed", "error": str(result)}
+            if isinstance(result, BaseException) else result
+            for username, result in zip(usernames, results)
+        ] + skipped_summary
+
         logger.info(f"Daily processing completed. Summary: {result_summary}")
     except Exception as e:
         logger.error(f"Error in scheduled task: {e}")
 
 
-# APScheduler setup
-scheduler = BackgroundScheduler()
+# APScheduler setup; jobs are awaited on the app's event loop
+scheduler = AsyncIOScheduler()
 
 # Schedule the task to run daily at 00:01 AM Pacific Time
 pacific_time_trigger = CronTrigger(
     hour=0, minute=1, timezone="US/Pacific"
 )
 scheduler.add_job(process_messages_daily, pacific_time_trigger)
-scheduler.start()
 
 @app.get("/health")
 async def health_check():
@@ -168,6 +395,21 @@ async def health_check():
         "service": "Telegram Message Downloader"
     }
 
+@app.on_event("startup")
+async def startup_event():
+    """
+    Start the scheduler on the running event loop and check the S3 bucket once
+    so the scheduled runs don't pay for it.
+    """
+    scheduler.start()
+    logger.info("Scheduler started.")
+
+    try:
+        await create_s3_bucket(S3_BUCKET_NAME)
+    except Exception as e:
+        # Not fatal: the bucket is checked again on the next scheduled run
+        logger.error(f"Error checking S3 bucket on startup: {e}")
+
 @app.on_event("shutdown")
 async def shutdown_event():
     """
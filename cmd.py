@@ -1,16 +1,23 @@
 import argparse
 import logging
-import json
 import os
+import re
+import io
+import gzip
 import asyncio
-from datetime import datetime
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-import pytz
+import orjson
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception, retry_if_exception_type
 from telethon import TelegramClient
 from telethon.sessions import StringSession
-from telethon.errors import ChatInvalidError
+from telethon.errors import ChatInvalidError, ServerError
 import boto3
-from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionClosedError, ReadTimeoutError
+from botocore.exceptions import ConnectionError as BotoConnectionError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -28,25 +35,59 @@ PHONE_NUMBER = os.getenv('PHONENUMBER')
 AWS_REGION = os.getenv('AWS_REGION')
 S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
 
+# Shared S3 client settings: a connection pool large enough for concurrent uploads
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=32,
+    retries={'max_attempts': 3, 'mode': 'adaptive'}
+)
+
+# S3 error codes that are retried on top of 5xx responses
+TRANSIENT_S3_ERROR_CODES = {'SlowDown', 'RequestTimeout'}
+
+# Large dumps are sent as parallel multipart uploads, smaller ones as a single PUT.
+# UPLOAD_WORKERS * max_concurrency must stay within max_pool_connections above.
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True
+)
+
+# Maximum number of chats processed concurrently
+MAX_CONCURRENT_CHATS = 8
+
+# Usernames (leading @ already stripped) or numeric chat IDs; anything else is skipped
+USERNAME_PATTERN = re.compile(r'^([A-Za-z0-9_]{4,32}|-?[0-9]+)$')
+CHAT_ID_PATTERN = re.compile(r'^-?[0-9]+$')
+
+# Pending serialized chats buffered between the downloaders and the S3 uploaders
+UPLOAD_QUEUE_SIZE = 4
+UPLOAD_WORKERS = 4
+
 # Global Telegram client with in-memory session
 client = TelegramClient(StringSession(), API_ID, API_HASH)
 
+# Resolved input peers by username or chat ID, so repeat lookups skip the ResolveUsername request
+_entity_cache = {}
+
 
 def parse_date(date_string):
     """Parse date string to datetime object with UTC timezone."""
     try:
-        return datetime.strptime(date_string, "%Y-%m-%d").replace(tzinfo=pytz.UTC)
+        return datetime.strptime(date_string, "%Y-%m-%d").replace(tzinfo=timezone.utc)
     except ValueError:
         raise ValueError("Invalid date format. Use YYYY-MM-DD.")
 
 
+@lru_cache(maxsize=1)
 def create_s3_client():
-    """Create an S3 client using credentials from .env."""
+    """Return the shared S3 client, created on first use from .env credentials."""
     return boto3.client(
         's3',
         aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
         aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-        region_name=AWS_REGION
+        region_name=AWS_REGION,
+        config=S3_CLIENT_CONFIG
     )
 
 
@@ -54,11 +95,12 @@ async def create_s3_bucket(bucket_name):
     """Create an S3 bucket if it doesn't exist."""
     s3_client = create_s3_client()
     try:
-        s3_client.head_bucket(Bucket=bucket_name)
+        await asyncio.to_thread(s3_client.head_bucket, Bucket=bucket_name)
         logger.info(f"Bucket '{bucket_name}' already exists.")
     except ClientError:
         try:
-            s3_client.create_bucket(
+            await asyncio.to_thread(
+                s3_client.create_bucket,
                 Bucket=bucket_name,
                 CreateBucketConfiguration={'LocationConstraint': AWS_REGION}
             )
@@ -68,12 +110,52 @@ async def create_s3_bucket(bucket_name):
             raise
 
 
-async def upload_file_to_s3(bucket_name, file_path, key):
-    """Upload a file to an S3 bucket and return the HTTPS URL."""
+def _is_transient_s3_error(exc):
+    """Whether an S3 failure is worth retrying: connection problems, timeouts, throttling and 5xx."""
+    # BotoConnectionError covers endpoint, proxy and connect-timeout failures
+    if isinstance(exc, (BotoConnectionError, ReadTimeoutError, ConnectionClosedError)):
+        return True
+    if isinstance(exc, ClientError):
+        code = exc.response.get('Error', {}).get('Code')
+        status = exc.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return status >= 500 or code in TRANSIENT_S3_ERROR_CODES
+    return False
+
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, max=8),
+    retry=retry_if_exception(_is_transient_s3_error),
+    reraise=True
+)
+async def _put_payload(s3_client, bucket_name, body, key):
+    """Send a gzip-compressed JSON Lines payload to S3, retrying transient failures with exponential backoff."""
+    if len(body) >= S3_TRANSFER_CONFIG.multipart_threshold:
+        await asyncio.to_thread(
+            s3_client.upload_fileobj,
+            io.BytesIO(body),
+            bucket_name,
+            key,
+            ExtraArgs={'ContentType': 'application/x-ndjson', 'ContentEncoding': 'gzip'},
+            Config=S3_TRANSFER_CONFIG
+        )
+    else:
+        await asyncio.to_thread(
+            s3_client.put_object,
+            Bucket=bucket_name,
+            Key=key,
+            Body=body,
+            ContentType='application/x-ndjson',
+            ContentEncoding='gzip'
+        )
+
+
+async def upload_json_to_s3(bucket_name, body, key):
+    """Upload gzip-compressed JSON Lines to an S3 bucket and return the HTTPS URL."""
     s3_client = create_s3_client()
     try:
-        s3_client.upload_file(file_path, bucket_name, key)
-        logger.info(f"File '{file_path}' uploaded to S3 bucket '{bucket_name}' as '{key}'.")
+        await _put_payload(s3_client, bucket_name, body, key)
+        logger.info(f"Object '{key}' uploaded to S3 bucket '{bucket_name}'.")
         region = os.getenv("AWS_REGION")
         s3_url = f"https://{bucket_name}.s3.{region}.amazonaws.com/{key}"
         return s3_url
@@ -82,33 +164,67 @@ async def upload_file_to_s3(bucket_name, file_path, key):
         raise
 
 
+def _write_payload(path, body):
+    """Write a gzip-compressed JSON Lines payload to disk in a single buffered write."""
+    with open(path, 'wb', buffering=1 << 20) as f:
+        f.write(body)
+
+
+async def _iter_messages(username, from_date=None, to_date=None):
+    """Yield text messages in the date range one at a time, newest first."""
+    # Newest first, starting just before offset_date; stop once past from_date
+    offset_date = to_date + timedelta(days=1) if to_date else None
+    from_day = from_date.date() if from_date else None
+    # Telethon treats an all-digit string as a phone number, so chat IDs must be ints
+    entity = int(username) if CHAT_ID_PATTERN.match(username) else username
+    peer = _entity_cache.get(entity)
+    if peer is None:
+        peer = await client.get_input_entity(entity)
+        _entity_cache[entity] = peer
+
+    async for message in client.iter_messages(peer, offset_date=offset_date):
+        if not message.date:
+            continue
+
+        # Telethon dates are already UTC
+        if from_day and message.date.date() < from_day:
+            break
+
+        if message.text:
+            yield {
+                "date": message.date.isoformat(),
+                "sender_id": message.sender_id,
+                "message": message.text,
+                "message_id": message.id
+            }
+
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, max=8),
+    retry=retry_if_exception_type((ConnectionError, ServerError)),
+    reraise=True
+)
+async def _fetch_jsonl(username, from_date=None, to_date=None):
+    """Serialize messages as JSON Lines while they stream in, retrying transient Telegram failures."""
+    buffer = io.BytesIO()
+    message_count = 0
+    async for message in _iter_messages(username, from_date, to_date):
+        buffer.write(orjson.dumps(message))
+        buffer.write(b"\n")
+        message_count += 1
+
+    return buffer.getvalue(), message_count
+
+
 async def download_chat_messages(username, from_date=None, to_date=None):
-    """Download messages from a Telegram chat with optional date filtering."""
+    """Download messages from a Telegram chat as JSON Lines bytes, with optional date filtering."""
     try:
         if not client.is_connected():
             await client.start(phone=PHONE_NUMBER)
 
-        messages = []
-        async for message in client.iter_messages(username, limit=None):
-            if not message.date:
-                continue
-
-            message_date = message.date.astimezone(pytz.UTC).date()
-
-            if from_date and message_date < from_date.date():
-                continue
-            if to_date and message_date > to_date.date():
-                continue
-
-            if message.text:
-                messages.append({
-                    "date": message.date.isoformat(),
-                    "sender_id": message.sender_id,
-                    "message": message.text,
-                    "message_id": message.id
-                })
-
-        return messages
+        body, _ = await _fetch_jsonl(username, from_date, to_date)
+        return body
     except ChatInvalidError:
         logger.error(f"Chat '{username}' not found.")
         raise ValueError(f"Chat '{username}' not found or inaccessible.")
@@ -117,27 +233,84 @@ async def download_chat_messages(username, from_date=None, to_date=None):
         raise
 
 
-async def process_chats(file_path, from_date=None, to_date=None):
+async def process_chats(file_path, from_date=None, to_date=None, keep_local=False):
     """Process a file containing usernames, download messages, and upload to S3."""
-    # Ensure the data directory exists
+    # Local copies are only kept on request
     data_folder = "data"
-    os.makedirs(data_folder, exist_ok=True)
+    if keep_local:
+        os.makedirs(data_folder, exist_ok=True)
 
     with open(file_path, 'r') as file:
-        usernames = [line.strip() for line in file.readlines()]
+        # Strip once (including a leading @), skip blank lines and drop duplicate chats, keeping file order
+        usernames = list(dict.fromkeys(filter(None, (line.strip().removeprefix('@') for line in file))))
 
-    await create_s3_bucket(S3_BUCKET_NAME)
+    # Drop malformed entries before any network work is started for them
     for username in usernames:
-        try:
-            messages = await download_chat_messages(username, from_date, to_date)
-            filename = os.path.join(data_folder, f"telegram_{username}_{datetime.now().strftime('%Y_%m_%d')}.json")
-            with open(filename, 'w') as f:
-                json.dump(messages, f, indent=4)
+        if not USERNAME_PATTERN.match(username):
+            logger.warning(f"Skipping '{username}': invalid username or chat ID.")
+    usernames = [username for username in usernames if USERNAME_PATTERN.match(username)]
 
-            s3_url = await upload_file_to_s3(S3_BUCKET_NAME, filename, os.path.basename(filename))
-            logger.info(f"Messages for '{username}' uploaded to S3: {s3_url}")
-        except Exception as e:
-            logger.error(f"Failed to process '{username}': {e}")
+    await create_s3_bucket(S3_BUCKET_NAME)
+
+    # Connect once up front so concurrent downloads don't race on client.start()
+    if not client.is_connected():
+        await client.start(phone=PHONE_NUMBER)
+
+    # One date tag per run, so a run that crosses midnight doesn't mix filenames
+    date_tag = datetime.now(timezone.utc).strftime('%Y_%m_%d')
+
+    sem = asyncio.Semaphore(MAX_CONCURRENT_CHATS)
+    queue = asyncio.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+
+    async def _download_user(username):
+        """Download and serialize messages for a single username, then queue them for upload."""
+        async with sem:
+            try:
+                body = await download_chat_messages(username, from_date, to_date)
+                filename = f"telegram_{username}_{date_tag}.jsonl.gz"
+            except Exception as e:
+                logger.error(f"Failed to process '{username}': {e}")
+                return
+
+            # Hold the download slot until the payload is queued, so at most
+            # MAX_CONCURRENT_CHATS + UPLOAD_QUEUE_SIZE payloads are in memory
+            await queue.put((username, filename, body))
+
+    async def producer():
+        """Download all chats, then signal each consumer to stop."""
+        results = await asyncio.gather(
+            *[_download_user(username) for username in usernames],
+            return_exceptions=True
+        )
+        for username, result in zip(usernames, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Failed to process '{username}': {result}")
+
+        for _ in range(UPLOAD_WORKERS):
+            await queue.put(None)
+
+    async def consumer():
+        """Upload queued JSON payloads to S3, optionally keeping a local copy."""
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+
+            username, filename, body = item
+            try:
+                # Compress in a worker thread so it overlaps with the downloads
+                body = await asyncio.to_thread(gzip.compress, body, compresslevel=3)
+
+                if keep_local:
+                    await asyncio.to_thread(_write_payload, os.path.join(data_folder, filename), body)
+
+                s3_url = await upload_json_to_s3(S3_BUCKET_NAME, body, filename)
+                logger.info(f"Messages for '{username}' uploaded to S3: {s3_url}")
+            except Exception as e:
+                logger.error(f"Failed to process '{username}': {e}")
+
+    # Uploads of finished chats overlap with downloads of the remaining ones
+    await asyncio.gather(producer(), *[consumer() for _ in range(UPLOAD_WORKERS)])
 
 
 def main():
@@ -145,13 +318,14 @@ def main():
     parser.add_argument("file", help="Path to file containing Telegram usernames")
     parser.add_argument("--from_date", help="Start date for filtering messages (YYYY-MM-DD)")
     parser.add_argument("--to_date", help="End date for filtering messages (YYYY-MM-DD)")
+    parser.add_argument("--keep_local", action="store_true", help="Also save the JSON files to the data folder")
 
     args = parser.parse_args()
 
     from_date = parse_date(args.from_date) if args.from_date else None
     to_date = parse_date(args.to_date) if args.to_date else None
 
-    asyncio.run(process_chats(args.file, from_date, to_date))
+    asyncio.run(process_chats(args.file, from_date, to_date, args.keep_local))
 
 
 if __name__ == "__main__":